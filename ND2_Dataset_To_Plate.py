@@ -38,166 +38,166 @@ __mail__ = "loic.sauteur@unibas.ch"
 __institution__ = "University of Basel"
 
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import re
+
 from omero.gateway import BlitzGateway
 import omero
 import omero.scripts as scripts
 
 from omero.rtypes import rint, rlong, rstring, robject, unwrap
 
+# images are called something like: "WellB2_...." (rows A-X, columns from 1)
+_WELL_RE = re.compile(r'^Well([A-X])([1-9]\d*)_')
+# maximum number of datasets processed in parallel
+_MAX_WORKERS = 8
+
 
-def add_images_to_plate(conn,
-                        images,
-                        plate_id,
-                        column, row,
-                        remove_from=None):
+def build_well(plate_ref, column, row, images):
     """
-    Creates wells and adds images to wells of a plate
-    :param conn: BlitzGateway
-    :param images: List of image objects
-    :param plate_id: integer plate ID
+    Creates a well (not saved) containing the images of a plate
+    :param plate_ref: unloaded PlateI object, shared by all wells
     :param column: Integer
     :param row: Integer
-    :param remove_from: Bool (if to remove the images form the dataset)
-    :return: boolean,
-        in case Exception was raised when images are added to wells,
-        it will be False. Otherwise, True (upon function end)
+    :param images: List of (image ID, image name) tuples
+    :return: WellI object, with its WellSampleI children
     """
-
-    update_service = conn.getUpdateService()
-
     well = omero.model.WellI()
-    well.plate = omero.model.PlateI(plate_id, False)
+    well.plate = plate_ref
     well.column = rint(column)
     well.row = rint(row)
 
-    try:
-        for image in images:
-            ws = omero.model.WellSampleI()
-            ws.image = omero.model.ImageI(image.id, False)
-            ws.well = well
-            well.addWellSample(ws)
-        update_service.saveObject(well)
-    except Exception:
-        return False
-
-    # remove from Dataset
+    for image_id, _ in images:
+        ws = omero.model.WellSampleI()
+        ws.image = omero.model.ImageI(image_id, False)
+        ws.well = well
+        well.addWellSample(ws)
+    return well
+
+
+def group_and_validate(images):
+    """
+    Groups the images into wells according to their name, and checks that
+    all wells have the same number of FOVs. Does not contact the server.
+    :param images: List of (image ID, image name) tuples
+    :return:
+        well_fovs: dict of (0-based row, column) to list of images,
+            or None if the images are not valid
+        message: String, describing an error, or None if no error
+    """
+    message = ""  # variable to return errors
+
+    if not images:
+        message += "Error: no images (matching the name filter) found"
+        print("The dataset does not contain any image",
+              "(matching the name filter).")
+        return None, message
+
+    # @modification: instead of putting the sorted images to wells,
+    #  the images are sorted into wells according to their name
+    # Dictionary with image list per well (0-based row, column)
+    well_fovs = defaultdict(list)  # will be e.g. (0, 0): [imageX, imageY]
     for image in images:
-        if remove_from is not None:
-            links = list(image.getParentLinks(remove_from.id))
-            link_ids = [l.id for l in links]
-            conn.deleteObjects('DatasetImageLink', link_ids)
-    return True
+        image_name = image[1]
+        # abort if imageName does not start with e.g. "WellB2_"
+        m = _WELL_RE.match(image_name)
+        if m is None:
+            message += "Error: could not find 'Well' in image: "
+            message += image_name
+            print("The dataset contains an image that does not start with",
+                  "'Well'. All images of the dataset must start with",
+                  "e.g. 'WellB2_' for this script to work.")
+            return None, message
+
+        wellName = (ord(m.group(1)) - 65, int(m.group(2)) - 1)
+        well_fovs[wellName].append(image)
+
+    # Return message if FOVs per well does not match for all images
+    fov_counts = {len(fovs) for fovs in well_fovs.values()}
+    if len(fov_counts) > 1:
+        message += "Error: not all wells seem to " \
+                   "have the same number of FOV"
+        print("The wells have", sorted(fov_counts), "images.",
+              "Only wells with the same number of images are supported.")
+        return None, message
+
+    return well_fovs, None
 
 
-def dataset_to_plate(conn, script_params, dataset_id, screen):
+def dataset_to_plate(conn, update_service, script_params, dataset_id,
+                     dataset_name, screen, well_fovs):
     """
     This function will put a single dataset into the specified screen.
     It is a modified version of the original script "Dataset_To_Plate.py".
     Main modification are about the sorting of images, and checking for erros.
     :param conn: BlitzGateway
+    :param update_service: the update service of conn
     :param script_params: dict of script parameters
     :param dataset_id: integer for dataset
+    :param dataset_name: String, name of the dataset (used for the plate)
     :param screen: ScreenI object
+    :param well_fovs: dict of (0-based row, column) to list of
+        (image ID, image name) tuples, already validated
+        (see group_and_validate)
     :return:
         plate: PlateI object
         link: ScreenPlateLinkI object
         delete_handle: List, for deleting the dataset
         message: String, describing an error, or None if no error
     """
+    # Do we try to remove images from Dataset & Delete Dataset when/if empty?
+    remove_dataset = bool(script_params.get("Remove_From_Dataset"))
 
-    message = ""  # variable to return errors
-
-    dataset = conn.getObject("Dataset", dataset_id)
-    if dataset is None:
-        return
-
-    update_service = conn.getUpdateService()
     # create Plate
     plate = omero.model.PlateI()
-    plate.name = omero.rtypes.RStringI(dataset.name)
+    plate.name = omero.rtypes.RStringI(dataset_name)
     plate.columnNamingConvention = rstring("number")  # always for nd2
     plate.rowNamingConvention = rstring("letter")  # always for nd2
     plate = update_service.saveAndReturnObject(plate)
+    plate_ref = omero.model.PlateI(plate.id.val, False)
 
     if screen is not None and screen.canLink():
         link = omero.model.ScreenPlateLinkI()
         link.parent = omero.model.ScreenI(screen.id, False)
-        link.child = omero.model.PlateI(plate.id.val, False)
+        link.child = plate_ref
         update_service.saveObject(link)
     else:
         link = None
 
-    # sort images by name
-    images = list(dataset.listChildren())
-    dataset_img_count = len(images)
-    if "Filter_Names" in script_params:
-        filter_by = script_params["Filter_Names"]
-        images = [i for i in images if i.getName().find(filter_by) >= 0]
-    images.sort(key=lambda x: x.name.lower())
+    dataset_img_count = sum(len(fovs) for fovs in well_fovs.values())
 
-    # Do we try to remove images from Dataset & Delete Dataset when/if empty?
-    remove_from = None
-    remove_dataset = "Remove_From_Dataset" in script_params and \
-                     script_params["Remove_From_Dataset"]
-    if remove_dataset:
-        remove_from = dataset
-
-    # @modification: instead of putting the sorted images to wells,
-    #  the images are sorted into wells according to their name
-    # Dictionary with image list per well-identifier (String)
-    well_fovs = {}  # will be e.g. "A1": [imageX, imageY]
-    for image in images:
-        # abort if imageName does not contain "Well"
-        if not image.getName().startswith('Well'):
-            message += "Error: could not find 'Well' in image: "
-            message += image.getName()
-            print("The dataset contains an image that does not start with",
-                  "'Well'. All images of the dataset must start with",
-                  "'Well' for this script to work.")
-            return None, None, None, message
-
-        # images are called something like: "WellB2_...."
-        wellName = image.getName().split("_")[0].replace("Well", "")
-
-        wellName = wellName.replace("Well", "")
-        if wellName not in well_fovs:
-            well_fovs[wellName] = [image]
-        else:
-            well_fovs[wellName].append(image)
-
-    images_per_well = None
-    for wellName in well_fovs.keys():
-        if images_per_well is None:
-            images_per_well = len(well_fovs[wellName])
-        else:
-            # Return message if FOVs per well does not match for all images
-            if images_per_well != len(well_fovs[wellName]):
-                message += "Error: not all wells seem to " \
-                           "have the same number of FOV"
-                print("The well", wellName, "has", len(well_fovs[wellName]),
-                      "images. But previous wells had", images_per_well,
-                      "images. Only wells with the same number of images",
-                      "are supported.")
-                return None, None, None, message
-
-    # create a dictionary to match row letters with corresponding numbers
-    row_numbers = {}
-    for i in range(1, 25):
-        row_numbers[chr(64 + i)] = i
-
-    # eventually, add images to plate
-    for wellName, images in well_fovs.items():
-        # mind the 0-based index
-        row_letter = str(wellName[0])
-        col_number = int(wellName[1:]) - 1
-        row_number = row_numbers[row_letter] - 1
-
-        added_count = add_images_to_plate(conn, images,
-                                          plate.getId().getValue(),
-                                          col_number, row_number,
-                                          remove_from)
-        # Info: added_count is from the original dataset_to_plate.py
-        # it makes not much sense here since it gets a boolean value
+    # eventually, add images to plate (all wells saved in one call)
+    wells = []
+    for (row_number, col_number), images in well_fovs.items():
+        wells.append(build_well(plate_ref, col_number, row_number, images))
+    try:
+        update_service.saveArray(wells, conn.SERVICE_OPTS)
+    except Exception as e:
+        # all wells are saved at once, so the plate is empty:
+        # delete it (and its screen link) instead of leaving it behind
+        conn.deleteObjects("Plate", [plate.id.val], wait=True)
+        message = "Error: could not add the images of dataset '%s' to " \
+                  "the plate wells (%s)" % (dataset_name, e)
+        print(message)
+        return None, None, None, message
+    added_count = True
+    # Info: added_count is from the original dataset_to_plate.py
+    # it makes not much sense here since it gets a boolean value
+
+    # remove from Dataset (all links of the plate deleted in one call)
+    iids = [iid for imgs in well_fovs.values() for iid, _ in imgs]
+    if remove_dataset and iids:
+        params = omero.sys.ParametersI()
+        params.add("pid", rlong(dataset_id))
+        params.addIds(iids)
+        query = "select l.id from DatasetImageLink l " \
+                "where l.parent.id = :pid and l.child.id in (:ids)"
+        link_ids = [unwrap(row)[0] for row in
+                    conn.getQueryService().projection(query, params,
+                                                      conn.SERVICE_OPTS)]
+        if link_ids:
+            conn.deleteObjects('DatasetImageLink', link_ids, wait=True)
 
     # if user wanted to delete dataset, AND it's empty we can delete dataset
     delete_dataset = False  # Turning this functionality off for now.
@@ -207,11 +207,82 @@ def dataset_to_plate(conn, script_params, dataset_id, screen):
             dcs = list()
             options = None  # {'/Image': 'KEEP'}    # don't delete the images!
             dcs.append(omero.api.delete.DeleteCommand(
-                "/Dataset", dataset.id, options))
+                "/Dataset", dataset_id, options))
             delete_handle = conn.getDeleteService().queueDelete(dcs)
     return plate, link, delete_handle, None
 
 
+def datasets_chunk_to_plates(conn, script_params, dataset_ids,
+                             dataset_names, dataset_well_fovs, screen):
+    """
+    Puts a chunk of datasets into plates, one after the other.
+    Used as a worker of datasets_to_plates. The images were validated
+    beforehand, so errors only come from the server: they are returned
+    as message of the dataset, and the other datasets are still converted.
+    If the server fails after the plate was created (e.g. saving the screen
+    link), that plate is left on the server.
+    :param conn: BlitzGateway, not shared with other workers
+    :param script_params: dict of script parameters
+    :param dataset_ids: List of integer dataset IDs
+    :param dataset_names: dict of dataset ID to dataset name
+    :param dataset_well_fovs: dict of dataset ID to the well_fovs of
+        the dataset (see group_and_validate)
+    :param screen: ScreenI object
+    :return: dict of dataset ID to the results of dataset_to_plate
+    """
+    update_service = conn.getUpdateService()
+    results = {}
+    for dataset_id in dataset_ids:
+        # This is where individual datasets are put into a plate
+        try:
+            results[dataset_id] = dataset_to_plate(
+                conn, update_service, script_params, dataset_id,
+                dataset_names[dataset_id], screen,
+                dataset_well_fovs[dataset_id])
+        except Exception as e:
+            message = "Error: could not convert dataset '%s' (%s)" \
+                      % (dataset_names[dataset_id], e)
+            print(message)
+            results[dataset_id] = None, None, None, message
+    return results
+
+
+def datasets_to_plates_parallel(conn, script_params, dataset_ids,
+                                dataset_names, dataset_well_fovs, screen):
+    """
+    Puts the datasets into plates, in parallel worker threads.
+    The BlitzGateway is not thread-safe, so every worker joins the
+    session of conn through a new client.
+    :param conn: BlitzGateway
+    :param script_params: dict of script parameters
+    :param dataset_ids: List of integer dataset IDs
+    :param dataset_names: dict of dataset ID to dataset name
+    :param dataset_well_fovs: dict of dataset ID to the well_fovs of
+        the dataset (see group_and_validate)
+    :param screen: ScreenI object
+    :return: dict of dataset ID to the results of dataset_to_plate
+    """
+    n_workers = min(_MAX_WORKERS, len(dataset_ids))
+    chunks = [dataset_ids[i::n_workers] for i in range(n_workers)]
+    worker_conns = []
+    results = {}
+    try:
+        for _ in chunks:
+            worker_conns.append(
+                BlitzGateway(client_obj=conn.c.createClient(secure=True)))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(datasets_chunk_to_plates, worker_conn,
+                                       script_params, chunk, dataset_names,
+                                       dataset_well_fovs, screen)
+                       for worker_conn, chunk in zip(worker_conns, chunks)]
+            for future in futures:
+                results.update(future.result())
+    finally:
+        for worker_conn in worker_conns:
+            worker_conn.c.closeSession()
+    return results
+
+
 def datasets_to_plates(conn: BlitzGateway, script_params):
     """
     This function will handle multiple datasets.
@@ -228,15 +299,17 @@ def datasets_to_plates(conn: BlitzGateway, script_params):
     message = ""  # from original dataset_to_plate
 
     # get the script parameters     -------------------------------------------
-    dtype = script_params['Data_Type']
-    ids = script_params['IDs']
+    ids = script_params['IDs']  # Data_Type: only Dataset is supported
+    filter_by = script_params.get("Filter_Names")
+    screen_param = script_params.get("Screen")
 
-    # Get the datasets ID
-    datasets = list(conn.getObjects(dtype, ids))
+    # Get the datasets ID, name and link permission
+    datasets = get_datasets(conn, ids)
 
     # Exclude datasets containing images already linked to a well
     n_datasets = len(datasets)
-    datasets = [x for x in datasets if not has_images_linked_to_well(conn, x)]
+    already_linked = datasets_already_linked(conn, [d[0] for d in datasets])
+    datasets = [d for d in datasets if d[0] not in already_linked]
     if len(datasets) < n_datasets:
         message += "Excluded %s out of %s dataset(s). " \
                    % (n_datasets - len(datasets), n_datasets)
@@ -246,19 +319,35 @@ def datasets_to_plates(conn: BlitzGateway, script_params):
         return None, message
 
     # Filter dataset IDs by permissions
-    ids = [ds.getId() for ds in datasets if ds.canLink()]
+    ids = [ds[0] for ds in datasets if ds[2]]
     if len(ids) != len(datasets):
-        perm_ids = [str(ds.getId()) for ds in datasets if not ds.canLink()]
+        perm_ids = [str(ds[0]) for ds in datasets if not ds[2]]
         message += "You do not have the permissions to add the images from" \
                    " the dataset(s): %s." % ",".join(perm_ids)
     if not ids:
         return None, message
 
+    # Get the images (ID and name) of all datasets at once
+    dataset_images = get_dataset_images(conn, ids, filter_by)
+
+    # Validate the images of all datasets before writing anything to the
+    # server, so that a failing dataset does not leave other plates behind
+    dataset_well_fovs = {}
+    for dataset_id in ids:
+        well_fovs, message1 = group_and_validate(
+            dataset_images.get(dataset_id, []))
+        if message1 is not None:
+            # @modification: addition compared to the original version
+            # return/abort. Causes: different number of FOVs per well, or
+            #   image names do not start with 'Well'
+            return None, message1
+        dataset_well_fovs[dataset_id] = well_fovs
+
     # find or create Screen if specified
     screen = None
     newscreen = None
-    if "Screen" in script_params and len(script_params["Screen"]) > 0:
-        s = script_params["Screen"]
+    if screen_param:
+        s = screen_param
         # see if this is ID of existing screen
         try:
             screen_id = int(s)
@@ -272,20 +361,26 @@ def datasets_to_plates(conn: BlitzGateway, script_params):
             newscreen = update_service.saveAndReturnObject(newscreen)
             screen = conn.getObject("Screen", newscreen.getId().getValue())
 
+    dataset_names = {ds[0]: ds[1] for ds in datasets}
+
+    if len(ids) == 1:
+        results = datasets_chunk_to_plates(conn, script_params, ids,
+                                           dataset_names, dataset_well_fovs,
+                                           screen)
+    else:
+        results = datasets_to_plates_parallel(conn, script_params, ids,
+                                              dataset_names,
+                                              dataset_well_fovs, screen)
+
     plates = []
     links = []
     deletes = []
     for dataset_id in ids:
-        # This is where individual datasets are put into a plate
-        plate, link, delete_handle, message1 = dataset_to_plate(conn,
-                                                                script_params,
-                                                                dataset_id,
-                                                                screen)
+        plate, link, delete_handle, message1 = results[dataset_id]
         if message1 is not None:
-            # @modification: addition compared to the original version
-            # return/abort. Causes: different number of FOVs per well, or
-            #   image names do not start with 'Well'
-            return None, message1
+            # server error: report it together with the created plates
+            message += message1 + "."
+            continue
 
         if plate is not None:
             plates.append(plate)
@@ -294,12 +389,10 @@ def datasets_to_plates(conn: BlitzGateway, script_params):
         if delete_handle is not None:
             deletes.append(delete_handle)
 
-    # wait for any deletes to finish
-    for handle in deletes:
-        cb = omero.callbacks.DeleteCallbackI(conn.c, handle)
-        while True:  # ms
-            if cb.block(100) is not None:
-                break
+    # wait for any deletes to finish, polling all of them together
+    pending = [omero.callbacks.DeleteCallbackI(conn.c, h) for h in deletes]
+    while pending:
+        pending = [cb for cb in pending if cb.block(20) is None]  # ms
 
     if newscreen:
         message += "New screen created: %s." % newscreen.getName().getValue()
@@ -324,27 +417,92 @@ def datasets_to_plates(conn: BlitzGateway, script_params):
     return robj, message
 
 
-def has_images_linked_to_well(conn, dataset):
+def get_datasets(conn, dataset_ids):
     """
-    Helper method from original dataset_to_plate.
-    Used to be located within the
-    datasets_to_plates(conn, script_params) function.
+    Loads the ID, name and link permission of all datasets in a single
+    query, instead of loading the full dataset objects.
+    The dataset itself is selected as "..._details_permissions", so that the
+    server computes the permissions (restrictions) of the current user,
+    as done by OMERO.web.
     :param conn: BlitzGateway
-    :param dataset: DatasetI, I think
-    :return: Bool
+    :param dataset_ids: List of integer dataset IDs
+    :return: List of (dataset ID, dataset name, can link: Bool) tuples,
+        for the datasets that were found
     """
+    if not dataset_ids:
+        return []
     params = omero.sys.ParametersI()
-    query = "select count(well) from Well as well "\
-            "left outer join well.wellSamples as ws " \
-            "left outer join ws.image as img "\
-            "where img.id in (:ids)"
-    params.addIds([i.getId() for i in dataset.listChildren()])
-    n_wells = unwrap(conn.getQueryService().projection(
-        query, params, conn.SERVICE_OPTS)[0])[0]
-    if n_wells > 0:
-        return True
-    else:
-        return False
+    params.addIds(dataset_ids)
+    query = "select new map(d.id as id, d.name as name, " \
+            "d as d_details_permissions) from Dataset d " \
+            "where d.id in (:ids)"
+    result = conn.getQueryService().projection(query, params,
+                                               conn.SERVICE_OPTS)
+    datasets = []
+    for row in result:
+        d = unwrap(row)[0]
+        datasets.append((d["id"], d["name"],
+                         bool(d["d_details_permissions"]["canLink"])))
+    return datasets
+
+
+def get_dataset_images(conn, dataset_ids, filter_by=None):
+    """
+    Loads the image IDs and names of all datasets in a single query,
+    instead of loading the full image objects of each dataset.
+    Filtering and sorting by name is done by the server.
+    :param conn: BlitzGateway
+    :param dataset_ids: List of integer dataset IDs
+    :param filter_by: String, only images with names containing this value
+        (case-insensitive) are returned. Or None, for all images
+    :return: Dictionary of dataset ID to list of (image ID, image name),
+        sorted by image name
+    """
+    dataset_images = {}
+    if not dataset_ids:
+        return dataset_images
+    params = omero.sys.ParametersI()
+    params.addIds(dataset_ids)
+    query = "select dil.parent.id, img.id, img.name " \
+            "from DatasetImageLink dil join dil.child img " \
+            "where dil.parent.id in (:ids) "
+    if filter_by:
+        # escape the LIKE wildcards, to match the value literally
+        pattern = filter_by.lower().replace("\\", "\\\\") \
+            .replace("%", "\\%").replace("_", "\\_")
+        params.add("pat", rstring("%" + pattern + "%"))
+        query += "and lower(img.name) like :pat escape '\\' "
+    query += "order by lower(img.name)"
+    result = conn.getQueryService().projection(query, params,
+                                               conn.SERVICE_OPTS)
+    for row in result:
+        dataset_id, image_id, image_name = unwrap(row)
+        dataset_images.setdefault(dataset_id, []).append(
+            (image_id, image_name))
+    return dataset_images
+
+
+def datasets_already_linked(conn, dataset_ids):
+    """
+    Finds, in a single query, the datasets that contain images
+    already linked to a well.
+    Replaces the has_images_linked_to_well helper of the original
+    dataset_to_plate, which queried each dataset separately.
+    :param conn: BlitzGateway
+    :param dataset_ids: List of integer dataset IDs
+    :return: Set of integer dataset IDs
+    """
+    if not dataset_ids:
+        return set()
+    params = omero.sys.ParametersI()
+    params.addIds(dataset_ids)
+    # exists: the DB stops at the first well sample found for an image
+    query = "select distinct dil.parent.id from DatasetImageLink dil " \
+            "where dil.parent.id in (:ids) and exists (" \
+            "select ws.id from WellSample ws where ws.image = dil.child)"
+    result = conn.getQueryService().projection(query, params,
+                                               conn.SERVICE_OPTS)
+    return set(unwrap(row)[0] for row in result)
 
 
 def run_script():
@@ -374,7 +532,8 @@ def run_script():
 
         scripts.String(
             "Filter_Names", grouping="2.1",
-            description="Filter the images by names that contain this value"),
+            description="Filter the images by names that contain this value"
+                        " (case-insensitive)"),
 
         # did not use following script parameter
         #scripts.String(